@@ -1,44 +1,136 @@
 import sys
-import json
 import requests
-import csv
+from requests.adapters import HTTPAdapter
 import threading
+import select
+import socket
+import struct
+import queue
+import msgspec
+import numpy as np
 from PySide6.QtWidgets import (
     QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout,
-    QLabel, QSpinBox, QLineEdit, QFormLayout, QTextEdit, QFileDialog
+    QLabel, QSpinBox, QLineEdit, QFormLayout, QPlainTextEdit, QFileDialog, QCheckBox
 )
-from PySide6.QtNetwork import QUdpSocket, QHostAddress
-from PySide6.QtCore import QObject, Signal, Slot, QThread
+from PySide6.QtCore import QObject, Signal, Slot, QThread, QTimer
 import pyqtgraph as pg
 
-
-class UdpParseWorker(QObject):
-    parsed = Signal(str, float, float, float, float, float, float)  # ts, ax, ay, az, gx, gy, gz
+# Draw curves through OpenGL when PyOpenGL is available, otherwise stay on the raster path
+try:
+    import OpenGL  # noqa: F401
+    pg.setConfigOptions(useOpenGL=True, enableExperimental=True)
+except ImportError:
+    pass
+pg.setConfigOptions(antialias=False)
+
+# Number of samples kept for the live plots and CSV export
+HISTORY = 200
+# Plot/readout refresh period; UDP packets only touch the buffers in between
+REDRAW_MS = 33
+# Fixed plot Y ranges (full scale of the IMU), so pyqtgraph never rescans the data for bounds
+ACCEL_RANGE_G = 4
+GYRO_RANGE_DPS = 2000
+# Log lines are buffered and flushed to the log window at this period
+LOG_FLUSH_MS = 250
+LOG_MAX_LINES = 2000
+# Per-packet log line, formatted straight from the parsed (ts, ax, ay, az, gx, gy, gz) tuple
+PACKET_LOG_FMT = "UDP packet: ts=%s accel=(%.3f,%.3f,%.3f) gyro=(%.3f,%.3f,%.3f)"
+# UDP receive: default kernel buffer size, max datagrams drained per wakeup, max datagram size
+RCVBUF_MIB = 12
+RECV_BATCH = 64
+RECV_SIZE = 2048
+
+
+# Binary wire format: uint64 timestamp + accel XYZ + gyro XYZ as float32, little-endian (32 bytes)
+BINARY_PACKET = struct.Struct("<Q6f")
+
+
+# JSON wire format of one IMU datagram (still accepted from older firmware)
+class Vec3(msgspec.Struct):
+    x: float
+    y: float
+    z: float
+
+
+class Sample(msgspec.Struct):
+    accel: Vec3
+    gyro: Vec3
+    timestamp: str = ""
+
+
+class UdpReceiveWorker(QObject):
+    parsed_batch = Signal(object)  # (timestamps list, float32 array of shape (B, 6): ax, ay, az, gx, gy, gz)
     bad = Signal(str)
 
-    @Slot(bytes)
-    def process(self, b: bytes):
-        try:
-            raw = b.decode("utf-8", errors="ignore")
-            msg = json.loads(raw)
-
-            ts = msg.get("timestamp", "")
-            ax = msg["accel"]["x"]
-            ay = msg["accel"]["y"]
-            az = msg["accel"]["z"]
-            gx = msg["gyro"]["x"]
-            gy = msg["gyro"]["y"]
-            gz = msg["gyro"]["z"]
-
-            self.parsed.emit(ts, ax, ay, az, gx, gy, gz)
-        except Exception as e:
-            self.bad.emit(f"Bad packet: {e}")
+    def __init__(self):
+        super().__init__()
+        self._dec = msgspec.json.Decoder(Sample)
+        # Single receive buffer for the lifetime of the worker: each datagram is fully
+        # decoded before the next recv_into, so no pool of buffers is needed
+        self._buf = bytearray(RECV_SIZE)
+        self._view = memoryview(self._buf)
+
+    # b is any bytes-like object; memoryview slices of the receive buffer are parsed in place.
+    # Returns (ts, (ax, ay, az, gx, gy, gz)).
+    # Only exact-size datagrams are binary; anything else must be valid JSON or it raises.
+    def parse(self, b):
+        if len(b) == BINARY_PACKET.size:
+            ts, *values = BINARY_PACKET.unpack_from(b)
+            return str(ts), values
+        s = self._dec.decode(b)
+        a, g = s.accel, s.gyro
+        return s.timestamp, (a.x, a.y, a.z, g.x, g.y, g.z)
+
+    # Runs until stop is set; drains and decodes everything pending per wakeup into one signal
+    @Slot(object, object)
+    def run(self, sock, stop):
+        buf, view = self._buf, self._view
+        with sock:
+            while not stop.is_set():
+                ready, _, _ = select.select([sock], [], [], 0.1)
+                if not ready:
+                    continue
+                timestamps, rows = [], []
+                for _ in range(RECV_BATCH):
+                    try:
+                        n = sock.recv_into(buf)
+                    except OSError:  # BlockingIOError once the socket is drained
+                        break
+                    try:
+                        ts, values = self.parse(view[:n])
+                    except Exception as e:
+                        self.bad.emit(f"Bad packet: {e}")
+                        continue
+                    timestamps.append(ts)
+                    rows.append(values)
+                if not rows:
+                    continue
+
+                # Stage the whole batch as float32, then drop non-finite rows in one pass;
+                # values beyond float32 range become inf in the cast and are rejected here too
+                with np.errstate(over="ignore"):
+                    stage = np.array(rows, dtype=np.float32)
+                ok = np.isfinite(stage).all(axis=1)
+                if not ok.all():
+                    for i in np.flatnonzero(~ok):
+                        self.bad.emit(f"Bad packet: non-finite value in {rows[i]}")
+                    stage = stage[ok]
+                    timestamps = [ts for ts, keep in zip(timestamps, ok) if keep]
+                if timestamps:
+                    self.parsed_batch.emit((timestamps, stage))
+
+
+# Quote a free-form CSV field the way csv.writer (QUOTE_MINIMAL) would
+def csv_field(s):
+    if any(c in s for c in ',"\r\n'):
+        return '"' + s.replace('"', '""') + '"'
+    return s
 
 
 class MainWindow(QWidget):
     # Signals to cross threads
-    datagram_signal = Signal(bytes)
-    http_done = Signal(str, str)  # path, text
+    listen_requested = Signal(object, object)  # bound socket, stop event
+    http_done = Signal(str, str, object)  # path, text, parsed JSON (/status only, else None)
     http_err = Signal(str, str)   # path, err text
 
     def __init__(self):
@@ -66,6 +158,12 @@ class MainWindow(QWidget):
         self.local_port_spin.setValue(9000)
         form.addRow("Local UDP Port", self.local_port_spin)
 
+        # Kernel receive buffer for the UDP socket (absorbs bursts while the UI is busy)
+        self.rcvbuf_spin = QSpinBox()
+        self.rcvbuf_spin.setRange(1, 64)
+        self.rcvbuf_spin.setValue(RCVBUF_MIB)
+        form.addRow("UDP Recv Buffer (MiB)", self.rcvbuf_spin)
+
         # Stream + control buttons
         btn_layout = QHBoxLayout()
         self.start_btn = QPushButton("Start Stream")
@@ -117,11 +215,20 @@ class MainWindow(QWidget):
 
         main_layout.addLayout(form)
 
-        # Log window
-        self.log = QTextEdit()
+        # Log window; per-packet lines are only formatted when asked for
+        self.verbose_chk = QCheckBox("Log every packet")
+        main_layout.addWidget(self.verbose_chk)
+        self.log = QPlainTextEdit()
         self.log.setReadOnly(True)
+        self.log.setMaximumBlockCount(LOG_MAX_LINES)
         main_layout.addWidget(self.log)
 
+        # Lines are queued here and appended in one go by _flush_log
+        self._log_buf = []
+        self._log_timer = QTimer(self)
+        self._log_timer.timeout.connect(self._flush_log)
+        self._log_timer.start(LOG_FLUSH_MS)
+
         # Accelerometer plot with legend
         self.plot_accel = pg.PlotWidget(title="Accelerometer X/Y/Z (g)")
         self.plot_accel.addLegend()
@@ -130,7 +237,6 @@ class MainWindow(QWidget):
             self.plot_accel.plot(pen="g", name="Accel Y"),
             self.plot_accel.plot(pen="b", name="Accel Z")
         ]
-        self.data_ax, self.data_ay, self.data_az = [], [], []
         main_layout.addWidget(self.plot_accel)
 
         # Gyroscope plot with legend
@@ -141,24 +247,41 @@ class MainWindow(QWidget):
             self.plot_gyro.plot(pen="g", name="Gyro Y"),
             self.plot_gyro.plot(pen="b", name="Gyro Z")
         ]
-        self.data_gx, self.data_gy, self.data_gz = [], [], []
         main_layout.addWidget(self.plot_gyro)
 
-        self.setLayout(main_layout)
+        # Pinned axes: samples 0..HISTORY on X, IMU full scale on Y (setX/YRange turn auto-range off)
+        for plot, y in ((self.plot_accel, ACCEL_RANGE_G), (self.plot_gyro, GYRO_RANGE_DPS)):
+            plot.setXRange(0, HISTORY, padding=0)
+            plot.setYRange(-y, y, padding=0)
 
-        # Extra: store timestamps for CSV
-        self.timestamps = []
+        # Cap each redraw at roughly one segment per pixel, however long HISTORY gets
+        for c in self.accel_curves + self.gyro_curves:
+            c.setDownsampling(auto=True, method="peak")
+            c.setClipToView(True)
 
-        # UDP socket (not bound until you press "Bind UDP")
-        self.udp_socket = QUdpSocket()
+        self.setLayout(main_layout)
 
-        # Background UDP parse thread
+        # Ring buffer: one record per sample (timestamp, accel XYZ, gyro XYZ); _idx is the next write slot
+        self._ring = np.zeros(HISTORY, dtype=[("ts", "U32"), ("a", np.float32, 3), ("g", np.float32, 3)])
+        self._idx = 0
+        self._filled = 0
+        self._dirty = False
+        self._xaxis = np.arange(HISTORY, dtype=np.float32)
+
+        # Render timer: redraw at most once per tick, however fast packets arrive
+        self._render_timer = QTimer(self)
+        self._render_timer.timeout.connect(self._redraw)
+        self._render_timer.start(REDRAW_MS)
+
+        # UDP thread (idle until you press "Bind UDP"); datagrams are received and
+        # decoded there and reach the UI as one signal per batch
+        self._udp_stop = None
         self.udp_thread = QThread(self)
-        self.udp_worker = UdpParseWorker()
+        self.udp_worker = UdpReceiveWorker()
         self.udp_worker.moveToThread(self.udp_thread)
-        self.datagram_signal.connect(self.udp_worker.process)     # main -> worker
-        self.udp_worker.parsed.connect(self.on_parsed)            # worker -> main
-        self.udp_worker.bad.connect(self.on_bad_packet)           # worker -> main
+        self.listen_requested.connect(self.udp_worker.run)             # main -> worker
+        self.udp_worker.parsed_batch.connect(self.on_parsed_batch)     # worker -> main
+        self.udp_worker.bad.connect(self.on_bad_packet)                # worker -> main
         self.udp_thread.start()
 
         # Signals
@@ -174,6 +297,23 @@ class MainWindow(QWidget):
         self.reset_target_btn.clicked.connect(lambda: self.send_http("/target/reset"))
         self.listen_btn.clicked.connect(self.bind_udp)
 
+        # Keep-alive HTTP session and a small pool of workers to run requests on. The workers
+        # are daemon threads so a request stuck on an unreachable ESP never delays exit.
+        self._http = requests.Session()
+        self._http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self._http_queue = queue.Queue()
+        for _ in range(4):
+            threading.Thread(target=self._http_worker, daemon=True).start()
+
+        # Query parameters for endpoints that take them, read from the form at click time
+        self._http_params = {
+            "/imu/delay": lambda: {"ms": self.delay_spin.value()},
+            "/target/set": lambda: {
+                "ip": self.target_ip.text(),
+                "port": self.target_port.value()
+            },
+        }
+
         # HTTP results back to UI thread
         self.http_done.connect(self.on_http_done)
         self.http_err.connect(self.on_http_err)
@@ -186,48 +326,63 @@ class MainWindow(QWidget):
         container.setLayout(hb)
         return container
 
+    @Slot()
+    def _flush_log(self):
+        if not self._log_buf:
+            return
+        # Always plain text: a batch must not be parsed as HTML because one line looks like it
+        self.log.appendPlainText("\n".join(self._log_buf))
+        self._log_buf.clear()
+
     def base_url(self):
         return self.esp_url.text().strip()
 
+    def _ordered(self):
+        # Unroll the ring buffer oldest -> newest (a view until it wraps)
+        if self._filled < HISTORY:
+            return self._ring[:self._filled]
+        i = self._idx
+        return np.concatenate((self._ring[i:], self._ring[:i]))
+
     def send_http(self, path, post=False):
-        # Run requests in a background thread
+        # Widgets are read here on the UI thread; only the request itself runs on a worker
+        url = f"{self.base_url()}{path}"
+        params = self._http_params.get(path)
+        params = params() if params else None
+        method = self._http.post if post else self._http.get
+
         def work():
             try:
-                url = f"{self.base_url()}{path}"
-                if path.startswith("/imu/delay"):
-                    r = requests.get(url, params={"ms": self.delay_spin.value()}, timeout=2)
-                elif path.startswith("/target/set"):
-                    r = requests.get(url, params={
-                        "ip": self.target_ip.text(),
-                        "port": self.target_port.value()
-                    }, timeout=2)
-                elif post:
-                    r = requests.post(url, timeout=2)
-                else:
-                    r = requests.get(url, timeout=2)
-                self.http_done.emit(path, r.text)
+                r = method(url, params=params, timeout=2)
+                data = None
+                if path == "/status":
+                    try:
+                        data = r.json()
+                    except ValueError:
+                        pass
+                self.http_done.emit(path, r.text, data)
             except Exception as e:
                 self.http_err.emit(path, str(e))
-        threading.Thread(target=work, daemon=True).start()
+        self._http_queue.put(work)
 
-    @Slot(str, str)
-    def on_http_done(self, path, text):
+    def _http_worker(self):
+        while True:
+            self._http_queue.get()()
+
+    @Slot(str, str, object)
+    def on_http_done(self, path, text, data):
         if path == "/status":
             self.status_label.setText(f"Status: {text}")
-            try:
-                data = json.loads(text)
-                if "last_calibration" in data:
-                    self.calib_label.setText(
-                        f"Calibration: last={data['last_calibration']} calibrating={data['calibrating']}"
-                    )
-            except Exception:
-                pass
-        self.log.append(f"HTTP {path}: {text}")
+            if isinstance(data, dict) and "last_calibration" in data:
+                self.calib_label.setText(
+                    f"Calibration: last={data['last_calibration']} calibrating={data.get('calibrating')}"
+                )
+        self._log_buf.append(f"HTTP {path}: {text}")
 
     @Slot(str, str)
     def on_http_err(self, path, err):
         self.status_label.setText(f"Error: {err}")
-        self.log.append(f"Error calling {path}: {err}")
+        self._log_buf.append(f"Error calling {path}: {err}")
 
     def set_delay(self):
         self.send_http(f"/imu/delay")
@@ -237,29 +392,46 @@ class MainWindow(QWidget):
 
     def bind_udp(self):
         port = self.local_port_spin.value()
-        if self.udp_socket.bind(QHostAddress.Any, port):
-            self.udp_socket.readyRead.connect(self.on_udp)
-            self.log.append(f"Listening on UDP port {port}")
-        else:
-            self.log.append(f"Failed to bind UDP port {port}")
+        rcvbuf = self.rcvbuf_spin.value() * 1024 * 1024
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            sock.bind(("0.0.0.0", port))
+        except OSError:
+            sock.close()
+            self._log_buf.append(f"Failed to bind UDP port {port}")
+            return
+        sock.setblocking(False)
+
+        # The kernel silently caps the request (net.core.rmem_max on Linux). Linux also
+        # reports double the granted size to account for its bookkeeping overhead.
+        granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if sys.platform.startswith("linux"):
+            granted //= 2
+        if granted < rcvbuf:
+            self._log_buf.append(f"UDP receive buffer capped at {granted} bytes (requested {rcvbuf})")
+
+        # Stop the previous receive loop (if any) and hand the new socket to the receiver
+        self._stop_udp()
+        self._udp_stop = threading.Event()
+        self.listen_requested.emit(sock, self._udp_stop)
+        self._log_buf.append(f"Listening on UDP port {port}")
+
+    def _stop_udp(self):
+        if self._udp_stop is not None:
+            self._udp_stop.set()
+            self._udp_stop = None
 
     def clear_data(self):
-        # Reset accel, gyro, and timestamps
-        self.data_ax.clear()
-        self.data_ay.clear()
-        self.data_az.clear()
-        self.data_gx.clear()
-        self.data_gy.clear()
-        self.data_gz.clear()
-        self.timestamps.clear()
+        # Reset accel, gyro, and timestamps (the buffers are simply overwritten later)
+        self._idx = 0
+        self._filled = 0
+        self._dirty = False
 
         # Reset the plot visuals
         for c in self.accel_curves + self.gyro_curves:
             c.setData([])
 
-        self.plot_accel.enableAutoRange()
-        self.plot_gyro.enableAutoRange()
-
         # Reset numeric readouts
         self.ax_lbl.setText("0.000000")
         self.ay_lbl.setText("0.000000")
@@ -268,67 +440,72 @@ class MainWindow(QWidget):
         self.gy_lbl.setText("0.000000")
         self.gz_lbl.setText("0.000000")
 
-        self.log.append("Data cleared and plots reset")
+        self._log_buf.append("Data cleared and plots reset")
 
     def save_csv(self):
         filename, _ = QFileDialog.getSaveFileName(self, "Save Data", "imu_data.csv", "CSV Files (*.csv)")
         if not filename:
             return
 
-        n = min(len(self.timestamps), len(self.data_ax), len(self.data_ay), len(self.data_az),
-                len(self.data_gx), len(self.data_gy), len(self.data_gz))
+        ring = self._ordered()
+        n = len(ring)
+        cols = ["ax", "ay", "az", "gx", "gy", "gz"]
 
-        DECIMALS = 6
-        def f(x):
-            return f"{float(x):.{DECIMALS}f}"
+        # Flatten to one scalar field per column so savetxt formats each line with a single % operation
+        # (timestamps come from the sender, so they are quoted when they contain CSV syntax)
+        rows = np.empty(n, dtype=[("index", np.int64), ("timestamp", object)] + [(c, np.float64) for c in cols])
+        rows["index"] = np.arange(n)
+        rows["timestamp"] = [csv_field(ts) for ts in ring["ts"].tolist()]
+        for k, c in enumerate(cols):
+            rows[c] = ring["a" if k < 3 else "g"][:, k % 3]
 
         try:
-            with open(filename, "w", newline="") as fcsv:
-                writer = csv.writer(fcsv)
-                writer.writerow(["index", "timestamp", "ax", "ay", "az", "gx", "gy", "gz"])
-                for i in range(n):
-                    writer.writerow([
-                        i,
-                        self.timestamps[i],
-                        f(self.data_ax[i]),
-                        f(self.data_ay[i]),
-                        f(self.data_az[i]),
-                        f(self.data_gx[i]),
-                        f(self.data_gy[i]),
-                        f(self.data_gz[i])
-                    ])
-            self.log.append(f"Saved {n} samples to {filename}")
+            with open(filename, "w", newline="", buffering=1 << 20) as fcsv:
+                np.savetxt(fcsv, rows, fmt=["%d", "%s"] + ["%.6f"] * len(cols), delimiter=",",
+                           header=",".join(["index", "timestamp"] + cols), comments="", newline="\r\n")
+            self._log_buf.append(f"Saved {n} samples to {filename}")
         except Exception as e:
-            self.log.append(f"Error saving CSV: {e}")
-
-    # Main thread: minimal work, just read datagrams and hand bytes to worker
-    def on_udp(self):
-        while self.udp_socket.hasPendingDatagrams():
-            datagram, _, _ = self.udp_socket.readDatagram(self.udp_socket.pendingDatagramSize())
-            # hand off to worker thread
-            self.datagram_signal.emit(bytes(datagram))
-
-    # Parsed result comes back from worker here, update UI/plots
-    @Slot(str, float, float, float, float, float, float)
-    def on_parsed(self, ts, ax, ay, az, gx, gy, gz):
-        self.timestamps.append(ts)
-
-        self.data_ax.append(ax); self.data_ay.append(ay); self.data_az.append(az)
-        self.data_gx.append(gx); self.data_gy.append(gy); self.data_gz.append(gz)
-
-        if len(self.data_ax) > 200:
-            self.data_ax.pop(0); self.data_ay.pop(0); self.data_az.pop(0)
-        if len(self.data_gx) > 200:
-            self.data_gx.pop(0); self.data_gy.pop(0); self.data_gz.pop(0)
-
-        self.accel_curves[0].setData(self.data_ax)
-        self.accel_curves[1].setData(self.data_ay)
-        self.accel_curves[2].setData(self.data_az)
-
-        self.gyro_curves[0].setData(self.data_gx)
-        self.gyro_curves[1].setData(self.data_gy)
-        self.gyro_curves[2].setData(self.data_gz)
-
+            self._log_buf.append(f"Error saving CSV: {e}")
+
+    # Parsed batch comes back from worker here; only the buffers are touched, _redraw paints
+    @Slot(object)
+    def on_parsed_batch(self, batch):
+        timestamps, stage = batch
+        if self.verbose_chk.isChecked():
+            self._log_buf.extend(
+                PACKET_LOG_FMT % (ts, *values) for ts, values in zip(timestamps, stage.tolist())
+            )
+
+        # Only the newest HISTORY samples can survive; write them into the ring in one go
+        timestamps, stage = timestamps[-HISTORY:], stage[-HISTORY:]
+        b = len(stage)
+        wrap = (self._idx + np.arange(b)) % HISTORY
+        self._ring["ts"][wrap] = timestamps
+        self._ring["a"][wrap] = stage[:, :3]
+        self._ring["g"][wrap] = stage[:, 3:]
+        self._idx = (self._idx + b) % HISTORY
+        self._filled = min(self._filled + b, HISTORY)
+        self._dirty = True
+
+    # Render timer: push the latest buffer contents to the plots and readouts
+    @Slot()
+    def _redraw(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+
+        # run() drops non-finite samples, so pyqtgraph's finite scan can be skipped
+        x = self._xaxis[:self._filled]
+        ring = self._ordered()
+        accel = ring["a"].T
+        gyro = ring["g"].T
+        for c, y in zip(self.accel_curves, accel):
+            c.setData(x, y, skipFiniteCheck=True)
+        for c, y in zip(self.gyro_curves, gyro):
+            c.setData(x, y, skipFiniteCheck=True)
+
+        ax, ay, az = accel[:, -1]
+        gx, gy, gz = gyro[:, -1]
         self.ax_lbl.setText(f"{ax:.6f}")
         self.ay_lbl.setText(f"{ay:.6f}")
         self.az_lbl.setText(f"{az:.6f}")
@@ -336,17 +513,14 @@ class MainWindow(QWidget):
         self.gy_lbl.setText(f"{gy:.6f}")
         self.gz_lbl.setText(f"{gz:.6f}")
 
-        self.log.append(
-            f"UDP packet: ts={ts} accel=({ax:.3f},{ay:.3f},{az:.3f}) "
-            f"gyro=({gx:.3f},{gy:.3f},{gz:.3f})"
-        )
-
     @Slot(str)
     def on_bad_packet(self, msg):
-        self.log.append(msg)
+        self._log_buf.append(msg)
 
     def closeEvent(self, event):
-        # Ensure worker thread exits cleanly
+        # Ensure the UDP thread exits cleanly
+        self._stop_udp()
+        self._http.close()
         if self.udp_thread.isRunning():
             self.udp_thread.quit()
             self.udp_thread.wait(1000)